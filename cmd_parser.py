@@ -10,13 +10,211 @@ Version: 1.0
 """
 
 import abc
+import asyncio
+import atexit
+from concurrent import futures
 import grpc
+import itertools
+import mmap
 import os
+import threading
 import image_pb2
 import image_pb2_grpc
 
-NEW_FILE_INCOMING = "NEW_FILE_INCOMING"
-IMG_TYPES = ('jpg', 'jpeg', 'png', 'tif')
+IMG_TYPES = frozenset({'jpg', 'jpeg', 'png', 'tif'})
+WRITE_BUFFER_SIZE = 1024 * 1024 # 1 MiB
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+# most systems allow 1024 buffers per writev call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+# files below LARGE_FILE_SIZE are sent whole in a single message, well
+# under the server's 64 MiB receive limit; larger ones in LARGE_CHUNK_SIZE
+# pieces
+LARGE_CHUNK_SIZE = 1024 * 1024 # 1 MiB
+LARGE_FILE_SIZE = 4 * 1024 * 1024 # 4 MiB
+
+# responses for gRPC status codes that mean something other than an
+# unreachable server
+RPC_ERROR_RESPONSES = {
+    grpc.StatusCode.RESOURCE_EXHAUSTED: "413, image exceeds the server's 64 MiB upload limit",
+}
+
+# channels are kept open and shared across requests to the same server
+CHANNEL_POOL_SIZE = 4
+# default channel options tuned for streaming large images. The message size
+# and frame size limits only take effect if the server accepts matching values
+CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', 64 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+    ('grpc.http2.max_pings_without_data', 0),
+    # grow the HTTP/2 flow control window to the bandwidth-delay product
+    ('grpc.http2.bdp_probe', 1),
+    ('grpc.http2.max_frame_size', 16 * 1024 * 1024 - 1),
+    # flush writes immediately rather than coalescing them
+    ('grpc.http2.write_buffer_size', 0),
+    ('grpc.keepalive_time_ms', 30000),
+    # give every channel in the pool its own connection
+    ('grpc.use_local_subchannel_pool', 1),
+]
+_CHANNEL_POOL = {}
+_CHANNEL_POOL_LOCK = threading.Lock()
+
+# completed files are flushed and closed in the background while the next
+# file is still streaming in
+_WRITE_POOL = futures.ThreadPoolExecutor(max_workers=8)
+
+
+def _get_channel(host, port, options):
+    """
+    Returns a long-lived (channel, stub) pair for the server at host/port. A
+    small pool of channels and their stubs is created on first use for each
+    host/port and set of options and handed out round-robin so requests skip
+    the connection handshake and spread across TCP connections.
+    """
+    key = (host, port, tuple(options))
+    with _CHANNEL_POOL_LOCK:
+        if key not in _CHANNEL_POOL:
+            host_port = host + ":" + str(port)
+            channels = []
+            for _ in range(CHANNEL_POOL_SIZE):
+                channel = grpc.insecure_channel(host_port, options=options)
+                atexit.register(channel.close)
+                channels.append((channel, image_pb2_grpc.ImageProcessorStub(channel)))
+            _CHANNEL_POOL[key] = (channels, itertools.count())
+        channels, counter = _CHANNEL_POOL[key]
+        return channels[next(counter) % CHANNEL_POOL_SIZE]
+
+def _write_parts(fd, parts):
+    """
+    Writes a list of received chunks to fd with a single vectored write where
+    supported, so the chunks never have to be copied into one buffer
+    """
+    if not hasattr(os, 'writev'):
+        os.write(fd, b"".join(parts))
+        return
+    views = [memoryview(part) for part in parts]
+    while views:
+        written = os.writev(fd, views[:IOV_MAX])
+        # drop the chunks written in full and trim a partially written one
+        while views and written >= len(views[0]):
+            written -= len(views[0])
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+
+def _finish_file(fd, parts):
+    """
+    Writes any remaining chunks and closes fd
+    """
+    try:
+        _write_parts(fd, parts)
+    finally:
+        os.close(fd)
+
+
+class _Receiver:
+    """
+    Writes the files streamed back by the server as their chunks arrive. Each
+    file starts with a frame carrying its header; the first file is the
+    processed image and the rest are thumbnails. Chunks are held until
+    WRITE_BUFFER_SIZE bytes are pending and then written together with one
+    writev call.
+    """
+    def __init__(self):
+        self._paths = []
+        self._fd = None
+        self._parts = []
+        self._buffered = 0
+        self._pending = []
+        self.errors = []
+
+    def on_message(self, process):
+        """
+        Handles one message from the server: writes out any small files packed
+        whole into it, starts a new file if it carries a header, and queues
+        its chunk for the current file. Errors are carried only on messages
+        that start a file
+        """
+        has_header = process.HasField("header")
+        files = process.files
+        if has_header or len(files) > 0:
+            self.errors = process.errors
+        for embedded in files:
+            self.on_header(embedded.header.filename)
+            self.on_chunk(embedded.data)
+        if has_header:
+            self.on_header(process.header.filename)
+        self.on_chunk(process.img_chunk_data)
+
+    def on_header(self, filename):
+        """
+        Hands the current file, if any, to the write pool to be flushed and
+        closed, and opens the file named by the header
+        """
+        if self._fd is not None:
+            self._pending.append(_WRITE_POOL.submit(_finish_file, self._fd, self._parts))
+            self._reset()
+        self._paths.append(f"client_{filename}")
+        self._fd = os.open(self._paths[-1], WRITE_FLAGS, 0o644)
+
+    def on_chunk(self, data):
+        """
+        Queues a chunk for the current file
+        """
+        self._parts.append(data)
+        self._buffered += len(data)
+        if self._buffered >= WRITE_BUFFER_SIZE:
+            _write_parts(self._fd, self._parts)
+            self._parts = []
+            self._buffered = 0
+
+    def close(self):
+        """
+        Closes the file currently being written, if any, and waits for the
+        files handed to the write pool to finish
+        """
+        if self._fd is not None:
+            _finish_file(self._fd, self._parts)
+            self._reset()
+        pending, self._pending = self._pending, []
+        for write in pending:
+            write.result()
+
+    def discard(self):
+        """
+        Closes and deletes every file received so far, for a response that
+        failed partway through and would otherwise leave truncated files
+        """
+        try:
+            self.close()
+        except OSError:
+            pass
+        for path in self._paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._paths = []
+
+    def _reset(self):
+        """
+        Forgets the current file once it has been handed off or closed
+        """
+        self._fd = None
+        self._parts = []
+        self._buffered = 0
+
+    def img(self):
+        """
+        Returns the path of the processed image
+        """
+        return self._paths[0] if self._paths else ""
+
+    def thumbnails(self):
+        """
+        Returns the paths of the thumbnails received
+        """
+        return self._paths[1:]
 
 class ICmdParser(abc.ABC):
     """
@@ -33,14 +231,19 @@ class CmdParser(ICmdParser):
     communication with a gRPC-based server stub. Clients create instances of
     the CmdParser, passing the commands and image files for processing.
     """
-    def __init__(self, src, cmds, host, port):
+    def __init__(self, src, cmds, host, port, channel_options=None):
         """
-        Constructor for the CmdParser class
+        Constructor for the CmdParser class. channel_options is an optional
+        list of (key, value) gRPC channel arguments that override the defaults
+        in CHANNEL_OPTIONS, e.g. to trade throughput for latency.
         """
         self.src = src
         self.cmds = cmds
         self.host = host
         self.port = port
+        options = dict(CHANNEL_OPTIONS)
+        options.update(channel_options or [])
+        self._channel_options = list(options.items())
         self._img_type = self._get_image_type()
 
     
@@ -51,115 +254,170 @@ class CmdParser(ICmdParser):
         results of the processing are collected by process_image and info
         returned to the client.
         """
+        recv = _Receiver()
+        src = None
+
+        # connect to gRPC server and establish channel stub`
+        if not self._is_supported_img():
+            return self._unsupported_response()
+        try:
+            src = self._open_src()
+            # connect to server, transmit, and receive images
+            channel, stub = _get_channel(self.host, self.port, self._channel_options)
+            processed_img = stub.ProcessImage(self._transmit_img(src))
+            
+            # iterate through chunks, writing each one straight to
+            # its output file and collecting errors (if any)
+            for process in processed_img:
+                recv.on_message(process)
+        except Exception as e:
+            recv.discard()
+            return self._failed_response(e)
+        else:    
+            return self._success_response(recv)
+        finally:
+            # close the last file received
+            recv.close()
+            if src is not None:
+                src.close()
+    
+
+    async def process_image_async(self):
+        """
+        Asynchronous version of process_image built on grpc.aio. The upload
+        and the response stream are both driven by the event loop, so several
+        images can be processed concurrently from one thread. Returns the same
+        dict as process_image.
+        """
+        recv = _Receiver()
+        src = None
         host_port = self.host + ":" + str(self.port)
-        new_img = b""
-        new_img_name = b""
-        error_msg = b""
-        encountered_thumbnail = False
-        response_dict = dict(
+
+        if not self._is_supported_img():
+            return self._unsupported_response()
+        # file opens, writes and closes run in worker threads so they never
+        # stall the other transfers sharing the event loop
+        try:
+            src = await asyncio.to_thread(self._open_src)
+            async with grpc.aio.insecure_channel(host_port, options=self._channel_options) as channel:
+                stub = image_pb2_grpc.ImageProcessorStub(channel)
+                processed_img = stub.ProcessImage()
+                sender = asyncio.create_task(self._send_img_async(processed_img, src))
+                try:
+                    async for process in processed_img:
+                        await asyncio.to_thread(recv.on_message, process)
+                except BaseException:
+                    # the response carries the call's real status, the
+                    # sender only sees its write fail
+                    sender.cancel()
+                    await asyncio.gather(sender, return_exceptions=True)
+                    raise
+                await sender
+        except Exception as e:
+            await asyncio.to_thread(recv.discard)
+            return self._failed_response(e)
+        else:
+            return self._success_response(recv)
+        finally:
+            await asyncio.to_thread(recv.close)
+            if src is not None:
+                await asyncio.to_thread(src.close)
+
+
+    async def _send_img_async(self, call, f):
+        """
+        Writes the requests of _transmit_img(f) to call. Each request is read
+        from the source file in a worker thread, so page faults on the mapped
+        file never block the event loop.
+        """
+        img_requests = self._transmit_img(f)
+        while True:
+            img_request = await asyncio.to_thread(next, img_requests, None)
+            if img_request is None:
+                break
+            await call.write(img_request)
+        await call.done_writing()
+
+
+    def _success_response(self, recv):
+        """
+        Builds the response dict from the files and errors received
+        """
+        return dict(
+            img=recv.img(),
+            thumbnail=recv.thumbnails(),
+            responses=list(recv.errors)
+        )
+
+
+    def _failed_response(self, e):
+        """
+        Builds the response dict for a request that raised e. ValueErrors
+        carry their own status, gRPC errors with a known status code map to
+        their response, anything else is reported as a server error.
+        """
+        if isinstance(e, ValueError):
+            responses = e
+        elif isinstance(e, grpc.RpcError) and e.code() in RPC_ERROR_RESPONSES:
+            responses = RPC_ERROR_RESPONSES[e.code()]
+        else:
+            print(e)
+            responses = "500, Unable to connect to server"
+        return dict(
+            img=None,
+            thumbnail=None,
+            responses=responses
+        )
+
+
+    def _unsupported_response(self):
+        """
+        Builds the response dict for an unsupported or missing file extension
+        """
+        print(f"Error: Image file, {self.src}, is not a supported type or missing file extension")
+        return dict(
             img="",
             thumbnail=[],
-            responses=[]
+            responses="400, invalid file type/missing extension"
         )
-        new_thumbnail = []
-        new_thumbnail_name = []
-        file_num = 0
 
-        # connect to gRPC server and establish channel stub`
-        if self._is_supported_img():
-            try:
-                self._check_file_exists()
-                with grpc.insecure_channel(host_port) as channel:
-                    # connect to server, transmit, and receive images
-                    stub = image_pb2_grpc.ImageProcessorStub(channel)
-                    processed_img = stub.ProcessImage(self._transmit_img())
-                    
-                    # iterate through chunks to collect images and errors (if any)
-                    for process in processed_img:
-                        error_msg = process.errors
-                        file_num = process.file_num
-
-                        # check if encountered sentinel to indicate to skip
-                        # this message frame for image
-                        if process.filename == NEW_FILE_INCOMING and not encountered_thumbnail:
-                            encountered_thumbnail = True
-                            new_thumbnail.append(b"")
-                            new_thumbnail_name.append(b"")
-                            continue
-
-                        # Skip message frame to process another thumbnail
-                        if process.filename == NEW_FILE_INCOMING:
-                            new_thumbnail.append(b"")
-                            new_thumbnail_name.append(b"")
-                            continue
-                        
-                        # load images from the first image sent until thumbnail
-                        if not encountered_thumbnail:
-                            new_img_name = process.filename
-                            new_img += process.img_chunk_data
-                        else: 
-                            new_thumbnail_name[file_num] = process.filename
-                            new_thumbnail[file_num] += process.img_chunk_data
-            except ValueError as ve:
-                response_dict['img'] = None
-                response_dict['thumbnail'] = None
-                response_dict['responses'] = ve
-                return response_dict
-            except Exception as e:
-                print(e)
-                response_dict['img'] = None
-                response_dict['thumbnail'] = None
-                response_dict['responses'] = "500, Unable to connect to server"
-                return response_dict
-            else:    
-                # save the errors to the dict
-                response_dict['responses'] = self.convert_to_list(error_msg)
-                
-                # save the images to file
-                with open(f"client_{new_img_name}", 'wb') as outfile:
-                    outfile.write(new_img)
-                    response_dict['img'] = f"client_{new_img_name}"
-                # save thumbnail    
-                if len(new_thumbnail_name) != 0:
-                    for i in range(len(new_thumbnail_name)):
-                        with open(f"client_{new_thumbnail_name[i]}", 'wb') as outfile:
-                            outfile.write(new_thumbnail[i])
-                            response_dict['thumbnail'].append(f"client_{new_thumbnail_name[i]}")
-                # set it none if not included
-                else:
-                    response_dict['thumbnail'] = []
-                return response_dict          
-        else:
-            print(f"Error: Image file, {self.src}, is not a supported type or missing file extension")
-            response_dict['responses'] = "400, invalid file type/missing extension"
-            return response_dict
-    
 
-    def _check_file_exists(self):
+    def _open_src(self):
         """
-        Checks if the image exists, if not a value error is raised
+        Opens the image for reading, if it does not exist a value error is
+        raised. Opening directly avoids a separate existence check.
         """
-        if not os.path.isfile(self.src):
+        try:
+            # unbuffered since the data is read through a memory mapping
+            return open(self.src, 'rb', buffering=0)
+        except (FileNotFoundError, IsADirectoryError):
             raise ValueError("404, file does not exist")
 
-    def _transmit_img(self):
+    def _transmit_img(self, f):
         """
-        Transmits the image to the gRPC-based server using the protobuf 
-        definition.
-        ref: https://stackoverflow.com/questions/4566498/what-is-the-idiomatic-way-to-iterate-over-a-binary-file
+        Transmits the image in the open file f to the gRPC-based server using
+        the protobuf definition. The file is memory mapped so each chunk is
+        sliced directly from the page cache rather than read into an
+        intermediate buffer.
         """
-        str_cmds = "\n".join(self.cmds)
-        CHUNK_SIZE = 64 * 1024 # 64 KiB
         # send image to server in chunks
         try:
-            with open(self.src,'rb') as f:
-                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
-                    if not chunk:
-                        break
+            # send the commands and image type once in a header frame, the
+            # following frames only carry image data
+            yield image_pb2.ImageRequest(
+                image_ops = self.cmds,
+                image_type = self._img_type)
+            size = os.fstat(f.fileno()).st_size
+            # an empty file cannot be mapped and has nothing to send
+            if size == 0:
+                return
+            # smaller files go in one message to cut per-message framing
+            # overhead, large ones are chunked
+            chunk_size = LARGE_CHUNK_SIZE if size >= LARGE_FILE_SIZE else size
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(0, size, chunk_size):
                     img_request = image_pb2.ImageRequest(
-                        image_ops = str_cmds,
-                        image_type = self._img_type,
-                        chunk_data = chunk)
+                        chunk_data = mm[offset:offset + chunk_size])
                     yield img_request
         except Exception as e:
             print(e)
@@ -177,26 +435,51 @@ class CmdParser(ICmdParser):
 
     def _get_image_type(self):
         """
-        Extracts the image type from the file name
+        Extracts the lowercased image type from the file name, or None if the
+        file name has no extension
         """
-        chunks = self.src.split('.')
-        length = len(chunks)
-        # return no image type if no split occurs
-        if length < 2:
-            return None
-        return chunks[length - 1]
-    
+        return os.path.splitext(self.src)[1].lstrip('.').lower() or None
+
+
+class CmdParserSession:
+    """
+    The CmdParserSession class processes many images against one image server.
+    The pooled channels and a worker pool are shared by every image sent
+    through the session instead of being set up for each CmdParser.
+    """
+    def __init__(self, host, port, channel_options=None, max_workers=CHANNEL_POOL_SIZE):
+        """
+        Constructor for the CmdParserSession class. max_workers bounds how
+        many images process_all sends to the server at once.
+        """
+        self.host = host
+        self.port = port
+        self._channel_options = channel_options
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def process(self, src, cmds):
+        """
+        Processes a single image and returns the same dict as
+        CmdParser.process_image()
+        """
+        parser = CmdParser(src, cmds, self.host, self.port, self._channel_options)
+        return parser.process_image()
+
+    def process_all(self, srcs, cmds):
+        """
+        Processes every image in srcs with the same commands, several at a
+        time, and returns a list of result dicts in the order of srcs
+        """
+        return list(self._executor.map(lambda src: self.process(src, cmds), srcs))
 
-    def convert_to_list(self, str_err):
+    def close(self):
         """
-        Converts a string of errors separated by newlines and returns a list.
+        Shuts down the worker pool, the channels stay pooled for reuse
         """
-        if str_err == "":
-            return []
-        error_list = str_err.split("\n")
-        err_num = len(error_list)
-        # remove extra index due to split on newline adding additional line
-        if error_list[err_num - 1] == "":
-            error_list = error_list[:err_num - 1]
-        return error_list
-    
\ No newline at end of file
+        self._executor.shutdown()
@@ -14,7 +14,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bimage.proto\"I\n\x0cImageRequest\x12\x11\n\timage_ops\x18\x01 \x01(\t\x12\x12\n\nimage_type\x18\x02 \x01(\t\x12\x12\n\nchunk_data\x18\x03 \x01(\x0c\"m\n\x0bImageReturn\x12\x12\n\nimage_type\x18\x01 \x01(\t\x12\x16\n\x0eimg_chunk_data\x18\x02 \x01(\x0c\x12\x10\n\x08\x66ilename\x18\x03 \x01(\t\x12\x10\n\x08\x66ile_num\x18\x04 \x01(\x05\x12\x0e\n\x06\x65rrors\x18\x05 \x01(\t2C\n\x0eImageProcessor\x12\x31\n\x0cProcessImage\x12\r.ImageRequest\x1a\x0c.ImageReturn\"\x00(\x01\x30\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bimage.proto\"I\n\x0cImageRequest\x12\x11\n\timage_ops\x18\x01 \x03(\t\x12\x12\n\nimage_type\x18\x02 \x01(\t\x12\x12\n\nchunk_data\x18\x03 \x01(\x0c\"D\n\nFileHeader\x12\x10\n\x08\x66ilename\x18\x01 \x01(\t\x12\x10\n\x08\x66ile_num\x18\x02 \x01(\x05\x12\x12\n\nimage_type\x18\x03 \x01(\t\"9\n\x0c\x45mbeddedFile\x12\x1b\n\x06header\x18\x01 \x01(\x0b\x32\x0b.FileHeader\x12\x0c\n\x04\x64\x61ta\x18\x02 \x01(\x0c\"p\n\x0bImageReturn\x12\x1b\n\x06header\x18\x01 \x01(\x0b\x32\x0b.FileHeader\x12\x16\n\x0eimg_chunk_data\x18\x02 \x01(\x0c\x12\x0e\n\x06\x65rrors\x18\x03 \x03(\t\x12\x1c\n\x05\x66iles\x18\x04 \x03(\x0b\x32\r.EmbeddedFile2C\n\x0eImageProcessor\x12\x31\n\x0cProcessImage\x12\r.ImageRequest\x1a\x0c.ImageReturn\"\x00(\x01\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -23,8 +23,12 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   DESCRIPTOR._options = None
   _globals['_IMAGEREQUEST']._serialized_start=15
   _globals['_IMAGEREQUEST']._serialized_end=88
-  _globals['_IMAGERETURN']._serialized_start=90
-  _globals['_IMAGERETURN']._serialized_end=199
-  _globals['_IMAGEPROCESSOR']._serialized_start=201
-  _globals['_IMAGEPROCESSOR']._serialized_end=268
+  _globals['_FILEHEADER']._serialized_start=90
+  _globals['_FILEHEADER']._serialized_end=158
+  _globals['_EMBEDDEDFILE']._serialized_start=160
+  _globals['_EMBEDDEDFILE']._serialized_end=217
+  _globals['_IMAGERETURN']._serialized_start=219
+  _globals['_IMAGERETURN']._serialized_end=331
+  _globals['_IMAGEPROCESSOR']._serialized_start=333
+  _globals['_IMAGEPROCESSOR']._serialized_end=400
 # @@protoc_insertion_point(module_scope)
@@ -10,12 +10,14 @@ Version: 1.0
 """
 
 import abc
+from dataclasses import dataclass, field
 import cv2
 import grpc
 import image_pb2
 import image_pb2_grpc
 import uuid
 import math
+import numpy as np
 import os
 
 # module constants used for performing command comparisons
@@ -29,6 +31,15 @@ THUMBNAIL = "thumbnail"
 HORIZONTAL = "horizontal"
 VERTICAL = "vertical"
 
+# opcodes of parsed commands, used as indices into the dispatch list
+OP_FLIP = 0
+OP_ROTATE = 1
+OP_GREYSCALE = 2
+OP_RESIZE = 3
+OP_THUMBNAIL = 4
+# commands that commute with greyscale, so greyscale can be moved before them
+GEOMETRIC_OPS = (OP_FLIP, OP_ROTATE, OP_RESIZE)
+
 # Constants used in comparisons and commands
 RIGHT_DEGREES = -90
 LEFT_DEGREES = 90
@@ -40,6 +51,37 @@ MAXIMUM_ROTATION = 10000
 HORIZ_FLIP = 1
 VERT_FLIP = 0
 DEGREES_MODULO = 360
+# counterclockwise right-angle rotations that cv2.rotate handles as a plain
+# transposed copy, no interpolation needed
+RIGHT_ANGLE_ROTATIONS = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_CLOCKWISE,
+}
+# imencode parameters per image type, trading a little encode time for
+# fewer bytes on the wire. Thumbnails are small enough to take a lower jpeg
+# quality without visible loss
+JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 85,
+               cv2.IMWRITE_JPEG_PROGRESSIVE, 1,
+               cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+THUMBNAIL_JPEG_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 75,
+                         cv2.IMWRITE_JPEG_PROGRESSIVE, 1,
+                         cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 6,
+              cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_DEFAULT]
+ENCODE_PARAMS = {'jpg': JPEG_PARAMS, 'jpeg': JPEG_PARAMS, 'png': PNG_PARAMS}
+THUMBNAIL_ENCODE_PARAMS = {'jpg': THUMBNAIL_JPEG_PARAMS,
+                           'jpeg': THUMBNAIL_JPEG_PARAMS,
+                           'png': PNG_PARAMS}
+# jpegs can be decoded straight at 1/2, 1/4 or 1/8 size. Each entry is the
+# largest leading resize factor that allows the reduction, the reduction, and
+# the colour and greyscale imread flags for it
+JPEG_TYPES = ('jpg', 'jpeg')
+REDUCED_READS = (
+    (0.125, 8, cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (0.25, 4, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (0.5, 2, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
 
 # codes
 SUCCESS_200 = 200
@@ -50,13 +92,26 @@ def uuid_generator(filetype):
     """
     Returns a uuid4 along with the image type
     """
-    return str(str(f"{uuid.uuid4()}.{filetype}"))
+    return f"{uuid.uuid4().hex}.{filetype}"
+
+@dataclass(slots=True)
+class ImgBag:
+    """
+    The working image, its thumbnails and their file names, passed through
+    each command as it is processed
+    """
+    img: np.ndarray | None
+    img_name: str | None = None
+    thumbnail: list = field(default_factory=list)
+    thumbnail_name: list = field(default_factory=list)
 
 class IImageProcessor(abc.ABC):
     """
     Abstract class for ImageProcessing. Must inherit from the processImage class
     to corrrectly inherit from the IImageProcessor.
     """
+    __slots__ = ()
+
     @abc.abstractmethod
     def process_image(self):
         pass
@@ -67,27 +122,163 @@ class ImageProcessor(IImageProcessor):
     and iterates through a list of commands. Returns a modified image as well
     as errors, and thumbnails (if requested).
     """
-    def __init__(self, img, string_cmds, img_type):
+    __slots__ = ('_img', '_cmds', '_img_type', '_new_img', '_new_thumbnail',
+                 '_errs', '_parse_errs', '_dispatch')
+
+    def __init__(self, img, cmds, img_type):
         """
-        Class constructor to set values and convert commands too a list
+        Class constructor to set values and parse each command. img is either a
+        path to the image, the encoded image bytes, or an already decoded image
+        array.
         """
         self._img = img
-        self._cmds = self._cmds_to_list(string_cmds)
         self._img_type = img_type
         self._new_img = None
         self._new_thumbnail = []
         self._errs = None 
+        # methods that perform each command, indexed by opcode
+        self._dispatch = [
+            self._flip_image,
+            self._rotate_image,
+            self._greyscale_image,
+            self._resize_image,
+            self._thumbnail_image,
+        ]
+        self._parse_errs = []
+        self._cmds = self._optimize_cmds(self._parse_cmds(cmds, self._parse_errs))
     
-    def _cmds_to_list(self, string_cmds):
+    def _parse_cmds(self, cmds, errs):
         """
-        Converts a string into a list based on new lines
+        Parses each command string into an (opcode, *args) tuple with its
+        arguments converted and checked, skipping blank commands. Invalid
+        commands are dropped and their errors added to errs in order.
         """
-        rows = string_cmds.split("\n")
-        new_list = []
-        for row in rows:
-            updated = row.split()
-            new_list.append(updated)
-        return new_list
+        parsed = []
+        for cmd in cmds:
+            words = cmd.split()
+            if len(words) == 0:
+                continue
+            op = self._parse_cmd(words, errs)
+            if op is not None:
+                parsed.append(op)
+        return parsed
+
+
+    def _parse_cmd(self, cmd, errs):
+        """
+        Parses the words of one command, returning its opcode tuple or None
+        after recording an error
+        """
+        if cmd[0] == FLIP:
+            if len(cmd) > 1 and cmd[1] == HORIZONTAL:
+                return (OP_FLIP, HORIZ_FLIP)
+            if len(cmd) > 1 and cmd[1] == VERTICAL:
+                return (OP_FLIP, VERT_FLIP)
+            errs.append((ERROR_400, f"{cmd[1:]} invalid parameter. Usage: flip <horizontal/vertical>"))
+        elif cmd[0] == ROTATE:
+            return self._parse_rotation(cmd, errs)
+        elif cmd[0] == GREYSCALE:
+            return (OP_GREYSCALE,)
+        elif cmd[0] == RESIZE:
+            return self._parse_resize(cmd, errs)
+        elif cmd[0] == THUMBNAIL:
+            return (OP_THUMBNAIL, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        else:
+            errs.append((ERROR_400, f"invalid function {cmd}"))
+        return None
+
+
+    def _parse_rotation(self, cmd, errs):
+        """
+        Parses a rotation given as left, right or an integer between -10000
+        and 10000 into the angle passed to opencv (counterclockwise degrees)
+        """
+        if len(cmd) < 2:
+            errs.append((ERROR_400, "Error: invalid parameter for rotation"))
+            return None
+        if cmd[1] == LEFT:
+            return (OP_ROTATE, LEFT_DEGREES)
+        if cmd[1] == RIGHT:
+            return (OP_ROTATE, RIGHT_DEGREES)
+        # strip out plus sign if provided
+        degrees = cmd[1][1:] if cmd[1].startswith("+") else cmd[1]
+        try:
+            degrees = int(degrees)
+            self._check_rotation_amt(degrees)
+        except ValueError:
+            errs.append((ERROR_400, f"'{degrees}' is invalid rotation parameters. Only integers allowed"))
+            return None
+        except Exception as e:
+            errs.append((ERROR_400, e))
+            return None
+        rotation = degrees % DEGREES_MODULO if degrees >= 0 else (-1 * ((-1 * degrees) % DEGREES_MODULO))
+        return (OP_ROTATE, -1 * rotation)
+
+
+    def _parse_resize(self, cmd, errs):
+        """
+        Parses a resize percentage between -95 and 500 into a scaling factor
+        """
+        if len(cmd) < 2:
+            errs.append((ERROR_400, "Error: invalid parameter for resize"))
+            return None
+        try:
+            percent_change = int(cmd[1])
+            self._check_dimension(percent_change)
+        except ValueError as ve:
+            errs.append((ERROR_400, ve))
+            return None
+        return (OP_RESIZE, self._convert_to_factor(percent_change))
+
+
+    def _optimize_cmds(self, cmds):
+        """
+        Rewrites the parsed command list to make fewer passes over the image.
+        Moves greyscale ahead of the flips, rotations and resizes directly
+        before it so they work on one channel, drops rotations by a multiple of
+        360 degrees, cancels back to back flips over the same axis, and fuses
+        back to back resizes into a single resize.
+        """
+        optimized = []
+        for cmd in cmds:
+            if cmd[0] == OP_GREYSCALE:
+                # stop at thumbnails, which must keep their colour
+                i = len(optimized)
+                while i > 0 and optimized[i - 1][0] in GEOMETRIC_OPS:
+                    i -= 1
+                optimized.insert(i, cmd)
+            elif cmd[0] == OP_ROTATE and cmd[1] % DEGREES_MODULO == 0:
+                continue
+            elif cmd[0] == OP_FLIP and len(optimized) > 0 and optimized[-1] == cmd:
+                optimized.pop()
+            elif cmd[0] == OP_RESIZE and len(optimized) > 0 and optimized[-1][0] == OP_RESIZE:
+                optimized.append((OP_RESIZE, optimized.pop()[1] * cmd[1]))
+            else:
+                optimized.append(cmd)
+        return optimized
+
+
+    def _read_flag(self):
+        """
+        Returns the flag to read the image with. When a jpeg is first shrunk to
+        half size or less it is decoded straight at a reduced size, and the
+        leading resize (and a greyscale before it) is rewritten to account for
+        the reduction already done.
+        """
+        if self._img_type not in JPEG_TYPES:
+            return cv2.IMREAD_COLOR
+        i = 1 if len(self._cmds) > 0 and self._cmds[0][0] == OP_GREYSCALE else 0
+        if i >= len(self._cmds) or self._cmds[i][0] != OP_RESIZE:
+            return cv2.IMREAD_COLOR
+        factor = self._cmds[i][1]
+        for max_factor, reduction, colour_flag, grey_flag in REDUCED_READS:
+            if factor <= max_factor:
+                self._cmds[i] = (OP_RESIZE, factor * reduction)
+                if i == 1:
+                    del self._cmds[0]
+                    return grey_flag
+                return colour_flag
+        return cv2.IMREAD_COLOR
 
     
     def process_image(self):
@@ -95,13 +286,19 @@ class ImageProcessor(IImageProcessor):
         Processes the image. Iterates through the list of commands and returns
         the image, thumbnails, and errors to the caller
         """
-        # iterate over all commands
-        errs = []
-        img = cv2.imread(self._img)
-        updated_imgs = dict(img=img,
-                            img_name=None,
-                            thumbnail=[],
-                            thumbnail_name=[])
+        # iterate over all commands, starting from the errors found parsing them
+        errs = list(self._parse_errs)
+        if isinstance(self._img, str):
+            img = cv2.imread(self._img, self._read_flag())
+        elif isinstance(self._img, (bytes, bytearray)):
+            img = cv2.imdecode(np.frombuffer(self._img, dtype=np.uint8), self._read_flag())
+        else:
+            img = self._img
+        updated_imgs = ImgBag(img)
+        # hold the input only through updated_imgs so it can be freed as soon
+        # as the first command replaces it
+        self._img = None
+        del img
         for cmd in self._cmds:
             updated_imgs, errs = self._execute_cmd(updated_imgs, cmd, errs)
         
@@ -110,150 +307,115 @@ class ImageProcessor(IImageProcessor):
             errs.append((SUCCESS_200, "Sucessfully processed image"))
         self._errs = errs
 
-        # write img to file to use to stream back to client    
-        updated_imgs['img_name'] = uuid_generator(self._img_type)
-        cv2.imwrite(updated_imgs['img_name'], updated_imgs['img'])
-        self._new_img = updated_imgs['img_name']
-
-        # Write thumbnails to file to prepare for transmission 
-        if len(updated_imgs['thumbnail']) != 0:
-            for i in range(len(updated_imgs['thumbnail'])):
-                updated_imgs['thumbnail_name'].append(uuid_generator(self._img_type))
-                cv2.imwrite(updated_imgs['thumbnail_name'][i], updated_imgs['thumbnail'][i])
-                self._new_thumbnail.append(updated_imgs['thumbnail_name'][i])
+        # encode img in memory to stream back to client
+        updated_imgs.img_name = uuid_generator(self._img_type)
+        self._new_img = (updated_imgs.img_name, self._encode(updated_imgs.img))
+        updated_imgs.img = None
+
+        # encode thumbnails to prepare for transmission 
+        for i in range(len(updated_imgs.thumbnail)):
+            updated_imgs.thumbnail_name.append(uuid_generator(self._img_type))
+            self._new_thumbnail.append((updated_imgs.thumbnail_name[i],
+                                        self._encode(updated_imgs.thumbnail[i],
+                                                     THUMBNAIL_ENCODE_PARAMS)))
+            updated_imgs.thumbnail[i] = None
         
-        # return image, thumbnails, errors, and type of image for use in server
+        # return (name, encoded image) pairs for the image and thumbnails,
+        # errors, and type of image for use in server
         return self._new_img, self._new_thumbnail, self._errs, self._img_type
 
 
+    def _encode(self, img, params=ENCODE_PARAMS):
+        """
+        Encodes an image to the image type of the request with the parameters
+        for that type, returning a flat uint8 array of the encoded file
+        """
+        _, buf = cv2.imencode(f".{self._img_type}", img,
+                              params.get(self._img_type, []))
+        return buf.reshape(-1)
+
+
     def _execute_cmd(self, imgs, cmd, errs):
         """
-        Processes the first chunk of a command and interprets the command to an
-        associated function. The command is called and the return value is 
-        returned from the call back to _execute_cmd()'s caller.
+        Looks up the method for the opcode of a parsed command in the dispatch
+        list. The command is called and the return value is returned from the
+        call back to _execute_cmd()'s caller.
         """
-        if cmd[0] == FLIP:
-            return self._flip_image(imgs, cmd, errs)
-        elif cmd[0] == ROTATE:
-            return self._rotate_image(imgs, cmd, errs)
-        elif cmd[0] == GREYSCALE:
-            return self._greyscale_image(imgs, errs)
-        elif cmd[0] == RESIZE:
-            return self._resize_image(imgs, cmd, errs)
-        elif cmd[0] == THUMBNAIL:
-            new_cmd = (THUMBNAIL, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
-            return self._thumbnail_image(imgs, new_cmd, errs)
-        else:
-            errs.append((ERROR_400, f"invalid function {cmd}"))
-            return imgs, errs
+        return self._dispatch[cmd[0]](imgs, cmd, errs)
         
     
     def _flip_image(self, imgs, cmd, errs):
         """
         Flips the image over the horizontal or vertical axis
         """
-        try:
-            # get commands from the paramter
-            flip_type = cmd[1]
-            if flip_type == HORIZONTAL:
-                flip_cmd = HORIZ_FLIP
-            elif flip_type == VERTICAL:
-                flip_cmd = VERT_FLIP
-            else:
-                raise TypeError(f"['{flip_type}'] invalid parameter. Usage: flip <horizontal/vertical>")
-            imgs['img'] = cv2.flip(imgs['img'], flip_cmd)
-            return imgs, errs
-        except TypeError as te:
-            errs.append((ERROR_400, te))
-            return imgs, errs
+        imgs.img = cv2.flip(imgs.img, cmd[1])
+        return imgs, errs
 
 
     def _rotate_image(self, imgs, cmd, errs):
         """
-        Rotates an image N degrees. The provided commands can be done with a 
-        word (left for counterclockwise 90 degrees, right for clockwise 90
-        degrees) or with an integer between -10000 and 10000
+        Rotates an image by the parsed angle in counterclockwise degrees,
+        expanding the image so nothing is cropped
         """
-        try:
-            # set degrees to the cmd argument, then test if string command followed 
-            # by casting as an int
-            degrees = cmd[1]
-            if degrees == LEFT:
-                rotation = LEFT_DEGREES
-            elif degrees == RIGHT:
-                rotation = RIGHT_DEGREES
-            else:
-                try:
-                    # strip out plus sign if provided
-                    if cmd[1].startswith("+"):
-                        cmd[1] = cmd[1][1:]
-                    degrees = int(cmd[1])
-                    self._check_rotation_amt(degrees)
-                    rotation = degrees % DEGREES_MODULO if degrees >= 0 else (-1 * ((-1 * degrees) % DEGREES_MODULO))
-                    rotation *= -1
-                except ValueError as ve:
-                    errs.append((ERROR_400, f"'{cmd[1]}' is invalid rotation parameters. Only integers allowed"))
-                    return imgs, errs
-                except Exception as e:
-                    errs.append((ERROR_400, e))
-                    return imgs, errs
-        except ValueError as ve:
-            print(f"Error {ve}: could not read degree rotation, returning original")
-            errs.append((ERROR_400, "Error: invalid parameter for rotation"))
+        rotation = cmd[1]
+        # no-op and right-angle rotations skip the affine warp
+        right_angle = rotation % DEGREES_MODULO
+        if right_angle == 0:
+            return imgs, errs
+        if right_angle in RIGHT_ANGLE_ROTATIONS:
+            imgs.img = cv2.rotate(imgs.img, RIGHT_ANGLE_ROTATIONS[right_angle])
             return imgs, errs
-        else:
-            """
-            Rotates an image (angle in degrees) and expands image to avoid cropping
-            https://stackoverflow.com/questions/22041699/rotate-an-image-without-cropping-in-opencv-in-c/33564950#33564950
-            """
-            height, width = imgs['img'].shape[:2]
-            image_center = (width / 2, height / 2)
 
-            rotation_mat = cv2.getRotationMatrix2D(image_center, rotation, 1)
+        """
+        Rotates an image (angle in degrees) and expands image to avoid cropping
+        https://stackoverflow.com/questions/22041699/rotate-an-image-without-cropping-in-opencv-in-c/33564950#33564950
+        """
+        height, width = imgs.img.shape[:2]
+        image_center = (width / 2, height / 2)
 
-            radians = math.radians(rotation)
-            sin = math.sin(radians)
-            cos = math.cos(radians)
-            bound_w = int((height * abs(sin)) + (width * abs(cos)))
-            bound_h = int((height * abs(cos)) + (width * abs(sin)))
+        rotation_mat = cv2.getRotationMatrix2D(image_center, rotation, 1)
 
-            rotation_mat[0, 2] += ((bound_w / 2) - image_center[0])
-            rotation_mat[1, 2] += ((bound_h / 2) - image_center[1])
+        radians = math.radians(rotation)
+        sin = math.sin(radians)
+        cos = math.cos(radians)
+        bound_w = int((height * abs(sin)) + (width * abs(cos)))
+        bound_h = int((height * abs(cos)) + (width * abs(sin)))
 
-            rotated_mat = cv2.warpAffine(imgs['img'], rotation_mat, (bound_w, bound_h))
-            imgs['img'] = rotated_mat
+        rotation_mat[0, 2] += ((bound_w / 2) - image_center[0])
+        rotation_mat[1, 2] += ((bound_h / 2) - image_center[1])
 
-            return imgs, errs
+        rotated_mat = cv2.warpAffine(imgs.img, rotation_mat, (bound_w, bound_h))
+        imgs.img = rotated_mat
 
+        return imgs, errs
 
-    def _greyscale_image(self, imgs, errs):
+
+    def _greyscale_image(self, imgs, cmd, errs):
         """
         converts image to greyscale
         """
         # Use the cvtColor() function to grayscale the image 
         # ref: https://www.geeksforgeeks.org/python-grayscaling-of-images-using-opencv/
-        imgs['img'] = cv2.cvtColor(imgs['img'], cv2.COLOR_BGR2GRAY)
+        imgs.img = cv2.cvtColor(imgs.img, cv2.COLOR_BGR2GRAY)
         return imgs, errs    
 
 
     def _resize_image(self, imgs, cmd, errs):
         """
-        Resizes an image according to a % scalaing factor provided
+        Resizes an image by the parsed scaling factor. Shrinking uses area
+        interpolation, which is faster and aliases less than linear, and a
+        factor of 1 leaves the image untouched.
         """
-        # get commands from the paramter
-        try:
-            percent_change = int(cmd[1])
-            self._check_dimension(percent_change)
-            factor = self._convert_to_factor(percent_change)
-            imgs['img'] = cv2.resize(imgs['img'], None, fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
-        except ValueError as ve:
-            errs.append((ERROR_400, ve))
+        factor = cmd[1]
+        if factor == 1:
             return imgs, errs
-        except Exception as e:
+        interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR
+        # the output size depends on the image, so it can still round to zero
+        try:
+            imgs.img = cv2.resize(imgs.img, None, fx=factor, fy=factor, interpolation=interpolation)
+        except cv2.error as e:
             errs.append((ERROR_400, e))
-            return imgs, errs
-        else:
-            return imgs, errs
+        return imgs, errs
     
 
     def _thumbnail_image(self, imgs, cmd, errs):
@@ -262,20 +424,18 @@ class ImageProcessor(IImageProcessor):
         thumbnail is appended to a list of thumbnails and does not replace any
         image.
         """
-         # get commands from the paramter
+        new_size = (cmd[1], cmd[2])
+        # shrink with area interpolation unless either side grows
+        height, width = imgs.img.shape[:2]
+        if new_size[0] <= width and new_size[1] <= height:
+            interpolation = cv2.INTER_AREA
+        else:
+            interpolation = cv2.INTER_LINEAR
         try:
-            # self._check_thumbnail_prescence(imgs)
-            new_size = (int(cmd[1]), int(cmd[2]))
-            # imgs['thumbnail'] = cv2.resize(imgs['img'], new_size)
-            imgs['thumbnail'].append(cv2.resize(imgs['img'], new_size))
-        except ValueError as ve:
-            errs.append((ERROR_400, ve))
-            return imgs, errs
-        except Exception as e:
+            imgs.thumbnail.append(cv2.resize(imgs.img, new_size, interpolation=interpolation))
+        except cv2.error as e:
             errs.append((ERROR_400, e))
-            return imgs, errs
-        else:
-            return imgs, errs
+        return imgs, errs
     
     def _check_dimension(self, percent):
         """
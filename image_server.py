@@ -9,17 +9,92 @@ Institution: Seattle University
 Version: 1.0
 """
 
+import argparse
+import asyncio
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
 import time
-import uuid
+import cv2
+from google.protobuf.internal import api_implementation
 import grpc
 import image_pb2
 import image_pb2_grpc
 import image_processor as ip
-import os
 
-CHUNK_SIZE = 64 * 1024 # 64 KiB
-NEW_FILE_INCOMING = "NEW_FILE_INCOMING"
+CHUNK_SIZE = 1024 * 1024 # 1 MiB
+# files up to this size are packed whole into shared frames, up to CHUNK_SIZE
+# bytes per frame
+SMALL_FILE_SIZE = 256 * 1024 # 256 KiB
+# must stay in line with CHANNEL_OPTIONS in cmd_parser so neither side
+# rejects the other's messages
+SERVER_OPTIONS = [
+    ('grpc.max_send_message_length', 64 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+    # grow the HTTP/2 flow control window to the bandwidth-delay product
+    ('grpc.http2.bdp_probe', 1),
+    ('grpc.http2.max_frame_size', 16 * 1024 * 1024 - 1),
+    # let several server processes bind the same port, the kernel spreads
+    # incoming connections across them
+    ('grpc.so_reuseport', 1),
+]
+ADDRESS = "localhost:10760"
+# largest upload accepted, larger streams are aborted rather than buffered
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024 # 64 MiB
+UPLOAD_TOO_LARGE = f"upload exceeds {MAX_UPLOAD_SIZE} bytes"
+WORKER_DIED = "image worker died while processing, please retry"
+CPU_COUNT = os.cpu_count() or 1
+# grpc threads only move bytes, the image work runs in the process pool
+GRPC_WORKERS = 2 * CPU_COUNT
+# opencv threads per worker process. The pool already runs one process per
+# core, so letting each cv2 call fan out again only oversubscribes the cpu.
+# For a few large images at a time, raise this to CPU_COUNT and shrink the
+# pool instead
+CV_THREADS = 1
+
+
+def init_worker():
+    """
+    Sets up opencv in each worker process of the cpu pool.
+    """
+    cv2.setNumThreads(CV_THREADS)
+    cv2.setUseOptimized(True)
+
+
+def run_image_job(img_binary, ops, img_type):
+    """
+    Decodes and processes an uploaded image. Runs in a worker process so the
+    python side of the processing isn't held up by the GIL of the grpc threads.
+    """
+    return ip.ImageProcessor(img_binary, ops, img_type).process_image()
+
+
+class _Upload:
+    """
+    Collects an image uploaded by the client. The commands and image type are
+    read from the first frame, every frame's data is appended in place rather
+    than re-copying the whole upload.
+    """
+    def __init__(self):
+        self.img_binary = bytearray()
+        self.ops = []
+        self.img_type = ""
+        self._first = True
+
+    def add(self, request):
+        """
+        Adds one request frame to the upload. Returns False once the upload has
+        grown past MAX_UPLOAD_SIZE and the call should be aborted
+        """
+        if self._first:
+            self.ops = list(request.image_ops)
+            self.img_type = request.image_type
+            self._first = False
+        self.img_binary.extend(request.chunk_data)
+        return len(self.img_binary) <= MAX_UPLOAD_SIZE
+
 
 class ImageProcessorServicer(image_pb2_grpc.ImageProcessorServicer):
     """
@@ -28,6 +103,36 @@ class ImageProcessorServicer(image_pb2_grpc.ImageProcessorServicer):
     to an instance of the ImageProcessor class and finally streams it back to 
     the client.
     """
+    def __init__(self, cpu_workers=CPU_COUNT):
+        self._cpu_workers = cpu_workers
+        self._cpu_pool_lock = threading.Lock()
+        self._cpu_pool = self.new_cpu_pool()
+
+
+    def new_cpu_pool(self):
+        """
+        Creates the process pool the image work runs in.
+        """
+        # spawn rather than fork, forking a process with live grpc threads
+        # isn't safe
+        return futures.ProcessPoolExecutor(
+            max_workers=self._cpu_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker)
+
+
+    def replace_cpu_pool(self, pool):
+        """
+        Replaces pool after one of its workers died (e.g. OOM killed), which
+        leaves a ProcessPoolExecutor unusable for good. Only the first call to
+        notice a broken pool replaces it, later ones already see the new pool.
+        """
+        with self._cpu_pool_lock:
+            if self._cpu_pool is pool:
+                self._cpu_pool = self.new_cpu_pool()
+                pool.shutdown(wait=False)
+
+
     def ProcessImage(self, request_iterator, context):
         """
         Method that receives an iterator from the client stub (streaming
@@ -35,29 +140,23 @@ class ImageProcessorServicer(image_pb2_grpc.ImageProcessorServicer):
         of the imageprocessor class. After processing the image is returned
         back to the client.
         """
-        img_return = image_pb2.ImageReturn()
-        img_binary = b''
-        ops = ""
-        img_type = ""
-        i = 0
+        upload = _Upload()
         for request in request_iterator:
-            ops = request.image_ops
-            img_type = request.image_type
-            img_binary += request.chunk_data
-            i += 1
-        
-        # write the file to binary so processor class can read
-        temp_filename = str(f"{uuid.uuid4()}.{img_type}")
-        with open(temp_filename, 'wb') as outfile:
-            outfile.write(img_binary)
+            if not upload.add(request):
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, UPLOAD_TOO_LARGE)
         
-        # pass the image to the processor class
-        img_proc = ip.ImageProcessor(temp_filename, ops, img_type)
-
-        # process image and collect errors and names to transmit back
-        img, thumbs, errs, type = img_proc.process_image()
-        # delete temporary file
-        os.remove(temp_filename)
+        # decode and process the image in the cpu pool, collecting errors and
+        # encoded images to transmit back. The upload is dropped once it has
+        # been handed over so it can be freed while the response streams. If
+        # a worker died the pool is replaced and only this call fails
+        pool = self._cpu_pool
+        try:
+            job = pool.submit(run_image_job, upload.img_binary, upload.ops, upload.img_type)
+            del upload
+            img, thumbs, errs, type = job.result()
+        except BrokenProcessPool:
+            self.replace_cpu_pool(pool)
+            context.abort(grpc.StatusCode.INTERNAL, WORKER_DIED)
 
         # return the images back to the client
         yield from self.transmit_img(img, thumbs, errs, type)
@@ -66,103 +165,174 @@ class ImageProcessorServicer(image_pb2_grpc.ImageProcessorServicer):
     def transmit_img(self, img, thumbnails, errs, type):
         """
         Transmits the image(s) back to the client along with any errors and
-        thumbnail(s) that were requested.
-        ref: https://stackoverflow.com/questions/4566498/what-is-the-idiomatic-way-to-iterate-over-a-binary-file
+        thumbnail(s) that were requested. img and each thumbnail are (filename,
+        encoded image) pairs; each file is sent as data frames sliced straight
+        from the encoded buffer, the first of which also carries the header
+        naming the file and the errors. Runs of small files, typically the
+        thumbnails, are packed whole into as few frames as possible instead.
         """
         
-        # prepare error string
-        err_msg = self.error_string(errs)
-        # send updated image back to client
-        try:
-            with open(img,'rb') as f:
-                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
-                    # print(chunk)
-                    if not chunk:
-                        break
-                    img_return = image_pb2.ImageReturn(
-                        image_type = type,
-                        img_chunk_data = chunk,
-                        filename = img,
-                        file_num = 0,
-                        errors = err_msg)
-                    yield img_return
-        except Exception as e:
-            print(e)
-        
-        # delete the stored file
-        os.remove(img)
-
-        # send back thumbnail(s), if any
-        if len(thumbnails) != 0:
-                    
-            # send back an empty return to indicate next file being sent
+        # prepare list of errors
+        err_msg = self.error_list(errs)
+        # one message is reused for every data frame, grpc serializes each
+        # yielded message before asking for the next
+        chunk_return = image_pb2.ImageReturn()
+        # send updated image back to client followed by the thumbnail(s)
+        files = [img] + thumbnails
+        packed = None
+        packed_size = 0
+        for i in range(len(files)):
+            filename, buf = files[i]
+            header = image_pb2.FileHeader(
+                filename = filename,
+                file_num = i,
+                image_type = type)
+            if len(buf) <= SMALL_FILE_SIZE:
+                # start a new packed frame when this file won't fit the current one
+                if packed is not None and packed_size + len(buf) > CHUNK_SIZE:
+                    yield packed
+                    packed = None
+                if packed is None:
+                    packed = image_pb2.ImageReturn(errors = err_msg)
+                    packed_size = 0
+                packed.files.add(header = header, data = buf.tobytes())
+                packed_size += len(buf)
+                continue
+            # keep the files in order, flush any packed files before this one
+            if packed is not None:
+                yield packed
+                packed = None
             img_return = image_pb2.ImageReturn(
-                            image_type = "",
-                            img_chunk_data = b"",
-                            filename = NEW_FILE_INCOMING,
-                            file_num = 0,
-                            errors = err_msg)
+                header = header,
+                img_chunk_data = buf[:CHUNK_SIZE].tobytes(),
+                errors = err_msg)
             yield img_return
-
-            for i in range(len(thumbnails)):
-                # Iterate over list of thumbnail images
-                try:
-                    with open(thumbnails[i],'rb') as f:
-                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
-                            if not chunk:
-                                break
-                            img_return = image_pb2.ImageReturn(
-                                image_type = type,
-                                img_chunk_data = chunk,
-                                filename = thumbnails[i],
-                                file_num = i,
-                                errors = err_msg)
-                            yield img_return
-                except Exception as e:
-                    print("error happening during open")
-                
-                # if additional images to transmit, add indicator to stream
-                if i < len(thumbnails) - 1:
-                    img_return = image_pb2.ImageReturn(
-                                    image_type = "",
-                                    img_chunk_data = b"",
-                                    filename = NEW_FILE_INCOMING,
-                                    file_num = i + 1,
-                                    errors = err_msg)
-                    yield img_return
-                    
-                # delete the stored file
-                os.remove(thumbnails[i])
+            for offset in range(CHUNK_SIZE, len(buf), CHUNK_SIZE):
+                chunk_return.img_chunk_data = buf[offset:offset + CHUNK_SIZE].tobytes()
+                yield chunk_return
+        if packed is not None:
+            yield packed
 
     
-    def error_string(self, errs):
+    def error_list(self, errs):
         """
-        Prepares a string of errors from a list of errors.
+        Prepares a list of error strings from a list of (code, error) tuples.
         """
-        error_msg = ""
-        for err in errs:
-            error_msg += f"{err[0]}, {err[1]}\n"
-        return error_msg
+        return [f"{code}, {msg}" for code, msg in errs]
 
 
-def serve():
+class AsyncImageProcessorServicer(ImageProcessorServicer):
+    """
+    ImageProcessorServicer for the grpc.aio server. Uploads are received and
+    responses streamed on the event loop while the image work runs in the cpu
+    pool, so no thread is tied up per request.
+    """
+    async def ProcessImage(self, request_iterator, context):
+        """
+        Async version of ImageProcessorServicer.ProcessImage. Awaits the cpu
+        pool instead of blocking on it.
+        """
+        upload = _Upload()
+        async for request in request_iterator:
+            if not upload.add(request):
+                await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, UPLOAD_TOO_LARGE)
+
+        pool = self._cpu_pool
+        try:
+            job = asyncio.get_running_loop().run_in_executor(
+                pool, run_image_job, upload.img_binary, upload.ops, upload.img_type)
+            del upload
+            img, thumbs, errs, type = await job
+        except BrokenProcessPool:
+            self.replace_cpu_pool(pool)
+            await context.abort(grpc.StatusCode.INTERNAL, WORKER_DIED)
+
+        for img_return in self.transmit_img(img, thumbs, errs, type):
+            yield img_return
+
+
+def serve(cpu_workers=CPU_COUNT):
     """
     Serves the image_proccessing API using the ImageProcessorServicer stub as 
     input for the grpc server.
     """
-    # setup server with up to 100 workers
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=100))
+    # setup server with a thread pool sized for network concurrency
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=GRPC_WORKERS),
+                         options=SERVER_OPTIONS,
+                         compression=grpc.Compression.NoCompression)
     # add ImageProcessorServer to the server to receive requests
     image_pb2_grpc.add_ImageProcessorServicer_to_server(
-        ImageProcessorServicer(),
+        ImageProcessorServicer(cpu_workers),
         server)
 
     # keep localhost for now
-    server.add_insecure_port("localhost:10760")
+    server.add_insecure_port(ADDRESS)
     server.start()
     print("started")
     server.wait_for_termination()
 
 
+async def serve_async(cpu_workers=CPU_COUNT):
+    """
+    Serves the image_proccessing API from a grpc.aio server using the
+    AsyncImageProcessorServicer.
+    """
+    server = grpc.aio.server(options=SERVER_OPTIONS,
+                             compression=grpc.Compression.NoCompression)
+    image_pb2_grpc.add_ImageProcessorServicer_to_server(
+        AsyncImageProcessorServicer(cpu_workers),
+        server)
+
+    # keep localhost for now
+    server.add_insecure_port(ADDRESS)
+    await server.start()
+    print("started")
+    await server.wait_for_termination()
+
+
+def run_serve_async(cpu_workers=CPU_COUNT):
+    """
+    Runs serve_async to completion, for use as a process target.
+    """
+    asyncio.run(serve_async(cpu_workers))
+
+
+def serve_processes(target, processes):
+    """
+    Runs target (serve or run_serve_async) in several server processes bound
+    to the same port, splitting the cpu pool workers between them.
+    """
+    cpu_workers = max(1, CPU_COUNT // processes)
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=target, args=(cpu_workers,))
+             for _ in range(processes)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+
+def check_protobuf_backend():
+    """
+    Warns when protobuf is running its pure python implementation, which makes
+    building and serializing every streamed chunk far slower than the upb or
+    cpp backends.
+    """
+    if api_implementation.Type() == "python":
+        print("warning: protobuf is using the pure python implementation, "
+              "install a protobuf wheel with the upb backend (4.21+)")
+
+
 if __name__ == "__main__":
-    serve()
\ No newline at end of file
+    check_protobuf_backend()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sync", action="store_true",
+                        help="serve from the threaded grpc server")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of server processes sharing the port")
+    args = parser.parse_args()
+    target = serve if args.sync else run_serve_async
+    if args.processes > 1:
+        serve_processes(target, args.processes)
+    else:
+        target()
\ No newline at end of file